@@ -1,8 +1,10 @@
 import argparse
+import functools
 import ipaddress
 import re
 import shlex
 from collections import defaultdict
+from collections.abc import Iterable
 
 from z3 import *
 
@@ -96,13 +98,24 @@ def create_iptables_argparse() -> argparse.ArgumentParser:
     return parser
 
 
+def _create_default_policy_re(chain: str) -> re.Pattern:
+    return re.compile(
+        rf"^:{re.escape(chain)}\s+(?P<default_policy>(ACCEPT|DROP|REJECT))", re.M
+    )
+
+
+_DEFAULT_POLICY_RES: dict[str, re.Pattern] = {
+    chain: _create_default_policy_re(chain) for chain in ["INPUT", "FORWARD", "OUTPUT"]
+}
+_QUOTING_RE = re.compile(r"[\"'\\]")
+
+
 def extract_interfaces(iptables_rules_file: str) -> set[str]:
     interfaces = set()
-    parser = create_iptables_argparse()
 
     for rule_line in iptables_rules_file.splitlines():
         if rule_line.startswith("-A "):
-            args, _ = parser.parse_known_args(shlex.split(rule_line))
+            args, _ = Rule._parse_rule(rule_line)
             for arg in [
                 "in_interface",
                 "not_in_interface",
@@ -115,6 +128,19 @@ def extract_interfaces(iptables_rules_file: str) -> set[str]:
     return interfaces
 
 
+@functools.lru_cache(maxsize=4096)
+def _cidr_bounds(ip: str) -> tuple[int, int]:
+    # Rules commonly share networks, so each one is only parsed once
+    address, _, prefix = ip.partition("/")
+    ip_int = int(ipaddress.IPv4Address(address))
+    prefix_len = int(prefix) if prefix else 32
+    if not 0 <= prefix_len <= 32:
+        raise ValueError(f"Invalid prefix length in '{ip}'")
+    mask = (0xFFFFFFFF << (32 - prefix_len)) & 0xFFFFFFFF
+    ip_min = ip_int & mask
+    return ip_min, ip_min | (~mask & 0xFFFFFFFF)
+
+
 class Rule:
     PROTOCOL_ENUM = [
         "all",
@@ -132,15 +158,13 @@ class Rule:
     CHAIN_ENUM = ["INPUT", "FORWARD", "OUTPUT"]
     STATE_ENUM = ["NEW", "RELATED", "ESTABLISHED"]
     INTERFACE_ENUM = []
+    INTERFACE_INDEX: dict[str, int] = {}
     IPTABLES_PARSER = create_iptables_argparse()
 
     def __init__(self, rule: str):
         self.constraints = None
         self.iptables_rule = rule
-        rule = self._fix_not_rule(rule)
-        self.args, unknown_args = self.IPTABLES_PARSER.parse_known_args(
-            shlex.split(rule)
-        )
+        self.args, unknown_args = self._parse_rule(rule)
         # if unknown_args:
         #     print("Warning: Unhandled iptables arguments:", " ".join(unknown_args))
 
@@ -150,38 +174,87 @@ class Rule:
     def get_chain(self):
         return self.args.append
 
-    def _fix_not_rule(self, rule: str) -> str:
-        return rule.replace("! --", "--not-").replace("! -", "-n")
+    def get_interfaces(self) -> list[str]:
+        interfaces = []
+        for interface in [
+            self.args.in_interface,
+            self.args.not_in_interface,
+            self.args.out_interface,
+            self.args.not_out_interface,
+        ]:
+            if interface is not None:
+                interfaces.append(interface)
+        return interfaces
+
+    @classmethod
+    def _parse_rule(cls, rule: str) -> tuple[argparse.Namespace, list[str]]:
+        args, unknown_args = cls._parse_rule_values(rule)
+        # Every rule gets its own Namespace, so the cached values can't be altered
+        return argparse.Namespace(**dict(args)), list(unknown_args)
+
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def _parse_rule_values(
+        cls, rule: str
+    ) -> tuple[tuple[tuple[str, str | None], ...], tuple[str, ...]]:
+        # Cached, as rule lines are parsed again for every SolveTables instance
+        # and by extract_interfaces()
+        args, unknown_args = cls.IPTABLES_PARSER.parse_known_args(
+            cls._fix_not_args(cls._split_rule(rule))
+        )
+        return tuple(vars(args).items()), tuple(unknown_args)
+
+    @staticmethod
+    def _split_rule(rule: str) -> list[str]:
+        # shlex is only needed for quoted arguments (e.g. comments), plain
+        # whitespace splitting is considerably faster for all other rules
+        if _QUOTING_RE.search(rule) is None:
+            return rule.split()
+        return shlex.split(rule)
+
+    @staticmethod
+    def _fix_not_args(args: list[str]) -> list[str]:
+        # Map "! --arg" to "--not-arg" and "! -a" to "-na"
+        fixed_args = []
+        negate = False
+        for arg in args:
+            if negate and arg.startswith("--"):
+                arg = "--not-" + arg[2:]
+            elif negate and arg.startswith("-"):
+                arg = "-n" + arg[1:]
+            elif negate:
+                fixed_args.append("!")
+            negate = arg == "!"
+            if not negate:
+                fixed_args.append(arg)
+        if negate:
+            fixed_args.append("!")
+        return fixed_args
 
     @classmethod
     def _get_or_add_interface_index(cls, interface: str) -> int:
-        if interface not in cls.INTERFACE_ENUM:
+        index = cls.INTERFACE_INDEX.get(interface)
+        if index is None:
+            index = len(cls.INTERFACE_ENUM)
             cls.INTERFACE_ENUM.append(interface)
-        return cls.INTERFACE_ENUM.index(interface)
+            cls.INTERFACE_INDEX[interface] = index
+        return index
 
     def _create_ip_constraints(
-        self, var: BitVecRef, ip: str, invert: bool = False
+        self, st: "SolveTables", var: BitVecRef, ip: str, invert: bool = False
     ) -> list[BoolRef]:
-        cidr = ipaddress.ip_network(ip)
-        constraints = [
-            ULE(int(cidr[0]), var),
-            ULE(var, int(cidr[-1])),
-        ]
+        constraints = st._get_range_constraints(var, *_cidr_bounds(ip))
         if invert:
             constraints = [Or([Not(c) for c in constraints])]
         return constraints
 
     def _create_ip_range_constraints(
-        self, var: BitVecRef, ip_range: str, invert: bool = False
+        self, st: "SolveTables", var: BitVecRef, ip_range: str, invert: bool = False
     ) -> list[BoolRef]:
         start_ip, end_ip = ip_range.split("-")
-        start_cidr = ipaddress.ip_network(start_ip)
-        end_cidr = ipaddress.ip_network(end_ip)
-        constraints = [
-            ULE(int(start_cidr[0]), var),
-            ULE(var, int(end_cidr[-1])),
-        ]
-        return constraints
+        return st._get_range_constraints(
+            var, _cidr_bounds(start_ip)[0], _cidr_bounds(end_ip)[1]
+        )
 
     def _create_interface_constraints(
         self, var: BitVecRef, interface: str, invert: bool = False
@@ -190,9 +263,9 @@ class Rule:
         if interface is not None:
             if interface.endswith("*"):
                 sub_constraints = []
-                for i in self.INTERFACE_ENUM:
+                for index, i in enumerate(self.INTERFACE_ENUM):
                     if i.startswith(interface.rstrip("*")):
-                        constraint = var == self._get_or_add_interface_index(i)
+                        constraint = var == index
                         if invert:
                             constraint = Not(constraint)
                         sub_constraints.append(constraint)
@@ -220,27 +293,39 @@ class Rule:
     def _create_port_constraints(
         self, var: BitVecRef, port: str, invert: bool = False
     ) -> list[BoolRef]:
-        ports = [port]
+        port_ranges = []
+        for p in sorted(self._parse_port_range(p) for p in port.split(",")):
+            # Coalesce overlapping and adjacent ports into a single range
+            if port_ranges and p[0] <= port_ranges[-1][1] + 1:
+                port_ranges[-1] = (port_ranges[-1][0], max(port_ranges[-1][1], p[1]))
+            else:
+                port_ranges.append(p)
         constraints = []
-        if "," in port:
-            ports = port.split(",")
-        for port in ports:
-            if ":" in port:
-                port_range = port.split(":")
-                port_min = int(port_range[0])
-                port_max = int(port_range[-1])
-                if invert:
-                    constraints.append(Or(ULT(var, port_min), ULT(port_max, var)))
-                else:
-                    constraints.append(ULE(port_min, var))
-                    constraints.append(ULE(var, port_max))
+        for port_min, port_max in port_ranges:
+            if not invert and port_min <= 0 and port_max >= (1 << var.size()) - 1:
+                # Matches every port (e.g. the default "0:65535"), same as "all"
+                return []
+            is_single_port = port_min == port_max
+            port_min = BitVecVal(port_min, var.size())
+            port_max = BitVecVal(port_max, var.size())
+            if is_single_port:
+                constraint = var == port_min
+                constraints.append(Not(constraint) if invert else constraint)
+            elif invert:
+                constraints.append(Or(ULT(var, port_min), ULT(port_max, var)))
             else:
-                constraint = var == int(port)
-                if invert:
-                    constraint = Not(constraint)
-                constraints.append(constraint)
+                constraints.append(And(ULE(port_min, var), ULE(var, port_max)))
+        # A list of ports (e.g. via multiport) is hit if any of the ports matches
+        if not invert and len(constraints) > 1:
+            constraints = [Or(constraints)]
         return constraints
 
+    def _parse_port_range(self, port: str) -> tuple[int, int]:
+        if ":" in port:
+            port_min, port_max = port.split(":")
+            return int(port_min or 0), int(port_max or 65535)
+        return int(port), int(port)
+
     def _create_state_constraints(self, var: BitVecRef, state: str) -> list[BoolRef]:
         states = []
         for s in state.split(","):
@@ -251,27 +336,27 @@ class Rule:
         sub_constraints = []
         if self.args.not_source:
             sub_constraints += self._create_ip_constraints(
-                st.src_ip_model, self.args.not_source, invert=True
+                st, st.src_ip_model, self.args.not_source, invert=True
             )
         elif self.args.src_range:
             sub_constraints += self._create_ip_range_constraints(
-                st.src_ip_model, self.args.src_range
+                st, st.src_ip_model, self.args.src_range
             )
         else:
             sub_constraints += self._create_ip_constraints(
-                st.src_ip_model, self.args.source
+                st, st.src_ip_model, self.args.source
             )
         if self.args.not_destination:
             sub_constraints += self._create_ip_constraints(
-                st.dst_ip_model, self.args.not_destination, invert=True
+                st, st.dst_ip_model, self.args.not_destination, invert=True
             )
         elif self.args.dst_range:
             sub_constraints += self._create_ip_range_constraints(
-                st.dst_ip_model, self.args.dst_range
+                st, st.dst_ip_model, self.args.dst_range
             )
         else:
             sub_constraints += self._create_ip_constraints(
-                st.dst_ip_model, self.args.destination
+                st, st.dst_ip_model, self.args.destination
             )
         if self.args.not_in_interface:
             sub_constraints += self._create_interface_constraints(
@@ -325,9 +410,29 @@ class Rule:
         # print("adding constraints:", constraints)
         self.constraints = constraints
 
+    def _get_constraints_key(self) -> tuple:
+        # Constraints only depend on the matches, not on the rule's chain or target
+        key = tuple(
+            sorted(
+                (k, v)
+                for k, v in vars(self.args).items()
+                if k not in ["append", "jump"]
+            )
+        )
+        if any(interface.endswith("*") for interface in self.get_interfaces()):
+            # Wildcards expand to the interfaces known at the time of building
+            key += (len(self.INTERFACE_ENUM),)
+        return key
+
     def get_constraints(self, st: "SolveTables") -> BoolRef:
         if self.constraints is None:
-            self._build_constraints(st)
+            key = self._get_constraints_key()
+            cached = st._rule_constraints.get(key)
+            if cached is None:
+                self._build_constraints(st)
+                st._rule_constraints[key] = self.constraints
+            else:
+                self.constraints = cached
         return self.constraints
 
 
@@ -364,6 +469,11 @@ class Chain:
         # (necessary for empty chains)
         pre_conditions = [BoolVal(False)]
         internal_preconditions = []
+        # Running Not(Or(pre_conditions + internal_preconditions)) and
+        # Not(Or(internal_preconditions)), extended by one term per rule instead
+        # of being rebuilt from the whole prefix each time
+        not_previous = BoolVal(True)
+        not_returned = BoolVal(True)
         for rule in self.rules:
             target: str = rule.get_target()
             rule_constraints = rule.get_constraints(solve_tables)
@@ -376,13 +486,15 @@ class Chain:
                     )
                     inner_constraints.append(
                         And(
-                            Not(Or(pre_conditions + internal_preconditions)),
+                            not_previous,
                             rule_constraints,
                             Or(target_inner_constraints),
                         )
                     )
                 if target == "RETURN":
                     internal_preconditions.append(rule_constraints)
+                    not_returned = And(not_returned, Not(rule_constraints))
+                    not_previous = And(not_previous, Not(rule_constraints))
                 else:
                     new_preconditions.append(rule_constraints)
                     target_post_conditions = target_chain.get_post_conditions(
@@ -392,13 +504,18 @@ class Chain:
                         new_preconditions.append(Or(target_post_conditions))
                     # Make sure previous "RETURN"s are taken into account
                     if len(internal_preconditions) > 0:
-                        new_preconditions.append(Not(Or(internal_preconditions)))
+                        new_preconditions.append(not_returned)
                     pre_conditions.append(And(new_preconditions))
+                    not_previous = And(not_previous, Not(pre_conditions[-1]))
         self._inner_constraints = inner_constraints
         self._post_conditions = pre_conditions
 
 
 class SolveTables:
+    SIMPLIFY_TACTIC: Tactic = Then("simplify", "propagate-values")
+    # All constraints are quantifier-free bit-vector formulas
+    SOLVER_LOGIC: str = "QF_BV"
+
     def __init__(
         self,
         default_policy: str,
@@ -406,6 +523,14 @@ class SolveTables:
         initial_interfaces: list[str] = [],
     ) -> None:
         self.reset_rules()
+        self._base_constraints: tuple[int, BoolRef] | None = None
+        self._chain_constraints: dict[str, BoolRef] = {}
+        self._rule_constraints: dict[tuple, BoolRef] = {}
+        self._shared_subexprs: dict[tuple[int, int, int], tuple[BoolRef, ...]] = {}
+        self._solvers: dict[str, Solver] = {}
+        self._identify_solver: Solver = SolverFor(self.SOLVER_LOGIC)
+        self._identify_chains: set[str] = set()
+        self._rule_selectors: dict[str, list[BoolRef]] = {}
         self.accept_default = default_policy == "ACCEPT"
         self.initial_interfaces = initial_interfaces
         for interface in initial_interfaces:
@@ -415,13 +540,31 @@ class SolveTables:
         self.dst_ip_model: BitVecRef = BitVec("dst_ip_model", 32)
         self.input_interface_model: BitVecRef = BitVec("input_interface_model", 8)
         self.output_interface_model: BitVecRef = BitVec("output_interface_model", 8)
-        self.protocol_model: BitVecRef = BitVec("protocol_model", 4)
+        self.protocol_model: BitVecRef = BitVec(
+            "protocol_model", len(Rule.PROTOCOL_ENUM).bit_length()
+        )
         self.src_port_model: BitVecRef = BitVec("src_port_model", 16)
         self.dst_port_model: BitVecRef = BitVec("dst_port_model", 16)
-        self.state_model: BitVecRef = BitVec("state_model", 4)
+        self.state_model: BitVecRef = BitVec(
+            "state_model", len(Rule.STATE_ENUM).bit_length()
+        )
+        self._model_vars: list[BitVecRef] = [
+            self.src_ip_model,
+            self.dst_ip_model,
+            self.input_interface_model,
+            self.output_interface_model,
+            self.protocol_model,
+            self.src_port_model,
+            self.dst_port_model,
+            self.state_model,
+        ]
+        self._model_var_sizes: list[int] = [var.size() for var in self._model_vars]
+        # Allows to evaluate all variables of a model at once
+        self._model_vector: BitVecRef = Concat(self._model_vars)
 
     def reset_rules(self):
         Rule.INTERFACE_ENUM = []
+        Rule.INTERFACE_INDEX = {}
 
     def _init_chains(self, rules: list[str]) -> dict[str, Chain]:
         chains = defaultdict(lambda: Chain("UNDEFINED", []))
@@ -430,14 +573,27 @@ class SolveTables:
         chain_rules = defaultdict(list)
         for rule in rules:
             new_rule = Rule(rule)
+            # Register interfaces upfront, so that wildcards expand to all of them.
+            # Wildcard names are registered as well and stand in for interfaces
+            # matching them that are not named anywhere else.
+            for interface in new_rule.get_interfaces():
+                Rule._get_or_add_interface_index(interface)
             chain_rules[new_rule.get_chain()].append(new_rule)
         for chain_name, rules_list in chain_rules.items():
             chains[chain_name] = Chain(chain_name, rules_list)
         return chains
 
+    def _get_constraints_version(self) -> int:
+        # Rules (and thereby chains) are fixed at construction, only the base
+        # constraints change with newly added interfaces (e.g. from expressions)
+        return len(Rule.INTERFACE_ENUM)
+
     def _get_base_constraints(self) -> Probe | BoolRef:
         if len(Rule.INTERFACE_ENUM) == 0:
             Rule._get_or_add_interface_index("any")
+        version = self._get_constraints_version()
+        if self._base_constraints is not None and self._base_constraints[0] == version:
+            return self._base_constraints[1]
         base_rules = And(
             ULT(self.protocol_model, len(Rule.PROTOCOL_ENUM)),
             ULT(self.input_interface_model, len(Rule.INTERFACE_ENUM)),
@@ -452,19 +608,47 @@ class SolveTables:
             # ULE(0, self.dst_port_model),
             # ULE(self.dst_port_model, 65535),
         )
+        self._base_constraints = (version, base_rules)
         return base_rules
 
-    def build_constraints(self, chain_name: str) -> Probe | BoolRef:
-        # print("self.constraints:", self.constraints)
-        # chain_constraints = self.get_chain_constraints(chain=chain, add_default=True)
+    def _get_range_constraints(
+        self, var: BitVecRef, lower: int, upper: int
+    ) -> list[BoolRef]:
+        if lower <= 0 and upper >= (1 << var.size()) - 1:
+            # Covers the whole domain (e.g. 0.0.0.0/0), so nothing to constrain
+            return []
+        # _cidr_bounds() only saves the parsing, this also saves building the same
+        # BitVecVal()/ULE() objects again (Z3 itself hash-conses equal nodes)
+        key = (var.get_id(), lower, upper)
+        constraints = self._shared_subexprs.get(key)
+        if constraints is None:
+            constraints = (
+                ULE(BitVecVal(lower, var.size()), var),
+                ULE(var, BitVecVal(upper, var.size())),
+            )
+            self._shared_subexprs[key] = constraints
+        return list(constraints)
+
+    def _get_chain_constraints(self, chain_name: str) -> BoolRef:
+        cached = self._chain_constraints.get(chain_name)
+        if cached is not None:
+            return cached
         chain = self.chains[chain_name]
-        chain_constraints = chain.get_inner_constraints(self)
+        chain_constraints = list(chain.get_inner_constraints(self))
         # Add handling of default ACCEPT target
         if self.accept_default:
             chain_constraints.append(Not(Or(chain.get_post_conditions(self))))
+        chain_constraints = Or(chain_constraints)
+        self._chain_constraints[chain_name] = chain_constraints
+        return chain_constraints
+
+    def build_constraints(self, chain_name: str) -> Probe | BoolRef:
+        # print("self.constraints:", self.constraints)
+        # chain_constraints = self.get_chain_constraints(chain=chain, add_default=True)
+        chain_constraints = self._get_chain_constraints(chain_name)
         base_rules = self._get_base_constraints()
 
-        combined_constraints = And(Or(chain_constraints), base_rules)
+        combined_constraints = And(chain_constraints, base_rules)
         # return combined_constraints
         return combined_constraints
         # return simplify(combined_constraints)
@@ -473,106 +657,145 @@ class SolveTables:
         self, chain: str, constraints: None | BoolRef
     ) -> None | ModelRef:
         m = None
-        s = Solver()
-        rules = self.build_constraints(chain)
+        s = self._get_solver(chain)
+        s.push()
         # print("final constraints:")
         # print(And(constraints, rules))
-        s.add(rules)
         if constraints is not None:
             s.add(constraints)
+        s.add(self._get_base_constraints())
         # print(s.sexpr())
         result = s.check()
         if result == sat:
             m = s.model()
+        s.pop()
         return m
 
+    def _get_solver(self, chain: str) -> Solver:
+        rules = self._get_chain_constraints(chain)
+        if chain not in self._solvers:
+            # Simplify once across rule boundaries, as the solver is reused for
+            # every query on this chain
+            goal = Goal()
+            goal.add(rules)
+            s = SolverFor(self.SOLVER_LOGIC)
+            s.add(self.SIMPLIFY_TACTIC(goal)[0].as_expr())
+            self._solvers[chain] = s
+        return self._solvers[chain]
+
+    def _get_identify_solver(self, chain: str) -> tuple[Solver, list[BoolRef]]:
+        s = self._identify_solver
+        selectors = self._rule_selectors.get(chain)
+        if selectors is None:
+            selectors = [
+                Bool(f"{chain}_rule_{i}") for i in range(len(self.chains[chain].rules))
+            ]
+            self._rule_selectors[chain] = selectors
+        if chain not in self._identify_chains:
+            # Each selector can only be true if its rule matches, so a single
+            # check reveals a matching rule instead of one check per rule.
+            for selector, rule in zip(selectors, self.chains[chain].rules):
+                rule_constraints = rule.get_constraints(self)
+                if rule_constraints is not None:
+                    s.add(Implies(selector, rule_constraints))
+                else:
+                    print(
+                        "This shouldn't happen! Rule constraints are None for:",
+                        rule.iptables_rule,
+                    )
+                    s.add(Not(selector))
+            self._identify_chains.add(chain)
+        return s, selectors
+
+    def _find_hit_rule_index(
+        self, chain: str, constraints: BoolRef, start: int = 0
+    ) -> None | int:
+        s, selectors = self._get_identify_solver(chain)
+        candidates = selectors[start:]
+        hit_index = None
+        s.push()
+        s.add(constraints, self._get_base_constraints())
+        # Narrow down until no earlier rule than the last hit can be matched
+        while candidates:
+            s.push()
+            s.add(Or(candidates))
+            m = s.model() if s.check() == sat else None
+            s.pop()
+            if m is None:
+                break
+            index = next(
+                i
+                for i, selector in enumerate(candidates)
+                if is_true(m.eval(selector, model_completion=True))
+            )
+            hit_index = start + index
+            candidates = candidates[:index]
+        s.pop()
+        return hit_index
+
     def translate_model(self, model: ModelRef):
-        protocol_index = (
-            model.eval(self.protocol_model, model_completion=True).as_long()
-            if model[self.protocol_model] is not None
-            else 0
-        )
+        vector = model.eval(self._model_vector, model_completion=True).as_long()
+        values = []
+        for size in reversed(self._model_var_sizes):
+            values.insert(0, vector & ((1 << size) - 1))
+            vector >>= size
+        (
+            src_ip,
+            dst_ip,
+            input_interface,
+            output_interface,
+            protocol,
+            src_port,
+            dst_port,
+            state,
+        ) = values
         translated_model = {
-            "src_ip": ipaddress.ip_address(
-                model.eval(self.src_ip_model, model_completion=True).as_long()
-            ),
-            "dst_ip": ipaddress.ip_address(
-                model.eval(self.dst_ip_model, model_completion=True).as_long()
-            ),
-            "input_interface": Rule.INTERFACE_ENUM[
-                model.eval(self.input_interface_model, model_completion=True).as_long()
-            ],
-            "output_interface": Rule.INTERFACE_ENUM[
-                model.eval(self.output_interface_model, model_completion=True).as_long()
-            ],
-            "protocol": Rule.PROTOCOL_ENUM[protocol_index],
-            "src_port": model.eval(
-                self.src_port_model, model_completion=True
-            ).as_long(),
-            "dst_port": model.eval(
-                self.dst_port_model, model_completion=True
-            ).as_long(),
-            "state": Rule.STATE_ENUM[
-                model.eval(self.state_model, model_completion=True).as_long()
-            ],
+            "src_ip": ipaddress.ip_address(src_ip),
+            "dst_ip": ipaddress.ip_address(dst_ip),
+            "input_interface": Rule.INTERFACE_ENUM[input_interface],
+            "output_interface": Rule.INTERFACE_ENUM[output_interface],
+            "protocol": Rule.PROTOCOL_ENUM[protocol],
+            "src_port": src_port,
+            "dst_port": dst_port,
+            "state": Rule.STATE_ENUM[state],
         }
         return translated_model
 
     def identify_rule_from_model(
         self, chain: str, model: ModelRef
     ) -> None | list[Rule]:
-        model_constraints_list = []
-        for var in [
-            self.src_ip_model,
-            self.dst_ip_model,
-            self.input_interface_model,
-            self.output_interface_model,
-            self.protocol_model,
-            self.src_port_model,
-            self.dst_port_model,
-            self.state_model,
-        ]:
-            if model[var] is not None:
-                model_constraints_list.append(var == model[var])
-        model_constraints = And(model_constraints_list)
+        bindings = [(var, model[var]) for var in self._model_vars]
+        model_constraints = And(
+            [var == value for var, value in bindings if value is not None]
+        )
         return self.identify_rule(chain=chain, constraints=model_constraints)
 
     def identify_rule(self, chain: str, constraints: BoolRef) -> None | list[Rule]:
         hit_rules = []
-        s = Solver()
-        for rule in self.chains[chain].rules:
-            rule_constraints = rule.get_constraints(self)
-            if rule_constraints is not None:
-                all_constraints = simplify(
-                    And(rule_constraints, self._get_base_constraints(), constraints)
-                )
-                s.add(all_constraints)
-                if s.check() == sat:
-                    hit_rules.append(rule)
-                    match rule.get_target():
-                        case "ACCEPT" | "RETURN":
-                            return hit_rules
-                        case "DROP" | "REJECT":
-                            print(
-                                "You should never see this, please report your parameters."
-                            )
-                            print(f"Hit {rule.get_target()} rule:")
-                            print(f"  {rule.iptables_rule}")
+        rules = self.chains[chain].rules
+        index = self._find_hit_rule_index(chain=chain, constraints=constraints)
+        while index is not None:
+            rule = rules[index]
+            hit_rules.append(rule)
+            match rule.get_target():
+                case "ACCEPT" | "RETURN":
+                    return hit_rules
+                case "DROP" | "REJECT":
+                    print("You should never see this, please report your parameters.")
+                    print(f"Hit {rule.get_target()} rule:")
+                    print(f"  {rule.iptables_rule}")
+                    return hit_rules
+                case _:
+                    additional_rules = self.identify_rule(
+                        chain=rule.get_target(), constraints=constraints
+                    )
+                    if additional_rules is not None:
+                        hit_rules += additional_rules
+                        if additional_rules[-1].get_target() != "RETURN":
                             return hit_rules
-                        case _:
-                            additional_rules = self.identify_rule(
-                                chain=rule.get_target(), constraints=constraints
-                            )
-                            if additional_rules is not None:
-                                hit_rules += additional_rules
-                                if additional_rules[-1].get_target() != "RETURN":
-                                    return hit_rules
-            else:
-                print(
-                    "This shouldn't happen! Rule constraints are None for:",
-                    rule.iptables_rule,
-                )
-            s.reset()
+            index = self._find_hit_rule_index(
+                chain=chain, constraints=constraints, start=index + 1
+            )
 
 
 class SolveTablesExpression:
@@ -718,9 +941,8 @@ def main():
     parser.add_argument("expression", nargs="+")
     args = parser.parse_args()
 
-    iptables_rules_file = args.iptables_save_log.read()
     solve_tables(
-        iptables_rules_file=iptables_rules_file,
+        iptables_rules_file=args.iptables_save_log,
         chain=args.chain,
         expression=args.expression,
         default_policy=args.default_policy,
@@ -729,7 +951,7 @@ def main():
 
 
 def solve_tables(
-    iptables_rules_file: str,
+    iptables_rules_file: str | Iterable[str],
     chain: str,
     expression: str,
     default_policy: str | None = None,
@@ -737,12 +959,29 @@ def solve_tables(
     parser: argparse.ArgumentParser = None,
     print=print,
 ):
+    if isinstance(iptables_rules_file, str):
+        iptables_rules_file = iptables_rules_file.splitlines()
+
+    default_policy_re = None
     if default_policy is None:
-        match = re.search(
-            f"^:{chain}\\s+(?P<default_policy>(ACCEPT|DROP|REJECT))",
-            iptables_rules_file.split("\n*filter\n")[-1],
-            re.M,
-        )
+        default_policy_re = _DEFAULT_POLICY_RES.get(chain)
+        if default_policy_re is None:
+            default_policy_re = _create_default_policy_re(chain)
+    match = None
+    rules: list[str] = []
+    # Rule lines are streamed, so large dumps are never held in memory as a whole
+    for rule_line in iptables_rules_file:
+        rule_line = rule_line.rstrip("\r\n")
+        if rule_line.startswith("-A "):
+            rules.append(rule_line)
+        elif default_policy_re is not None:
+            if rule_line == "*filter":
+                # Only consider the policies of the last filter table
+                match = None
+            elif match is None:
+                match = default_policy_re.match(rule_line)
+
+    if default_policy_re is not None:
         if match is None:
             if parser is not None:
                 parser.error(
@@ -752,18 +991,12 @@ def solve_tables(
             default_policy = match.group("default_policy")
             print(f"identified default policy for {chain} is {default_policy}")
 
-    interfaces = extract_interfaces(iptables_rules_file)
-    if additional_interfaces:
-        interfaces.update(additional_interfaces)
-    interfaces = list(interfaces)
-
-    rules: list[str] = []
-    for rule_line in iptables_rules_file.splitlines():
-        if rule_line.startswith("-A "):
-            rules.append(rule_line)
-
+    # Interfaces of the rules themselves, including wildcard names, are
+    # registered by SolveTables, just like extract_interfaces() collects them
     st = SolveTables(
-        default_policy=default_policy, rules=rules, initial_interfaces=interfaces
+        default_policy=default_policy,
+        rules=rules,
+        initial_interfaces=list(additional_interfaces or []),
     )
 
     st_expression = SolveTablesExpression(expression, st)
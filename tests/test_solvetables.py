@@ -1,8 +1,9 @@
+import io
 import ipaddress
 
 import pytest
 
-from solvetables import SolveTables, SolveTablesExpression
+from solvetables import SolveTables, SolveTablesExpression, solve_tables
 
 # TODO: Add explicit model result where known
 
@@ -1139,6 +1140,40 @@ class TestSimpleNotIPDefaultDrop(BaseTest):
         assert rules[0].iptables_rule == self.IPTABLES_RULES[0]
 
 
+class TestNotIPWithCommentDefaultDrop(BaseTest):
+    DEFAULT_POLICY = "DROP"
+    IPTABLES_RULES = [
+        '-A INPUT -m comment --comment "a ! -s b" ! -s 10.0.0.1 -j ACCEPT',
+    ]
+
+    def test_hit_drop(self, st: SolveTables):
+        additional_constraints = SolveTablesExpression(
+            "src_ip == 10.0.0.1", st
+        ).get_constraints()
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is None
+
+    def test_accept_not_address(self, st: SolveTables):
+        additional_constraints = SolveTablesExpression(
+            "src_ip == 10.0.0.2", st
+        ).get_constraints()
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is not None
+        model_dict = st.translate_model(model)
+        assert model_dict["src_ip"] == ipaddress.IPv4Address("10.0.0.2")
+
+        rules = st.identify_rule_from_model(chain="INPUT", model=model)
+        assert rules is not None
+        assert len(rules) == 1
+        assert rules[0].iptables_rule == self.IPTABLES_RULES[0]
+        assert rules[0].args.not_source == "10.0.0.1"
+        assert rules[0].args.source == "0.0.0.0/0"
+
+
 class TestNotInterfacesDefaultDrop(BaseTest):
     DEFAULT_POLICY = "DROP"
     IPTABLES_RULES = [
@@ -1281,9 +1316,58 @@ class TestInterfaceWildcardsDefaultDrop(BaseTest):
         assert model is None
 
 
+class TestSolveTablesInterfaceWildcard:
+    IPTABLES_SAVE = "\n".join(
+        [
+            "*filter",
+            ":INPUT DROP [0:0]",
+            "-A INPUT -i eth* -j ACCEPT",
+            "COMMIT",
+            "",
+        ]
+    )
+
+    def test_accept_wildcard(self):
+        model, translated_model = solve_tables(
+            iptables_rules_file=self.IPTABLES_SAVE,
+            chain="INPUT",
+            expression="src_port == 1",
+            print=lambda *x: None,
+        )
+        assert model is not None
+        assert translated_model["input_interface"] == "eth*"
+
+    def test_accept_wildcard_from_file(self):
+        model, translated_model = solve_tables(
+            iptables_rules_file=io.StringIO(self.IPTABLES_SAVE),
+            chain="INPUT",
+            expression="src_port == 1",
+            print=lambda *x: None,
+        )
+        assert model is not None
+        assert translated_model["input_interface"] == "eth*"
+
+
 # TODO: Add more test cases for interface wildcards
 
 
+class TestInterfaceWildcardBeforeInterfaceDefaultDrop(BaseTest):
+    DEFAULT_POLICY = "DROP"
+    IPTABLES_RULES = [
+        "-A INPUT -i eth* -j DROP",
+        "-A INPUT -i eth2 -j ACCEPT",
+    ]
+
+    def test_drop_later_interface(self, st: SolveTables):
+        additional_constraints = SolveTablesExpression(
+            "dst_port == 1", st
+        ).get_constraints()
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is None
+
+
 class TestSrcRangeDefaultAccept(BaseTest):
     DEFAULT_POLICY = "ACCEPT"
     IPTABLES_RULES = [
@@ -1620,3 +1704,204 @@ class TestDstRangeSingleIPDefaultDrop(BaseTest):
             chain="INPUT", constraints=additional_constraints
         )
         assert model is None
+
+
+class TestConstraintsCache(BaseTest):
+    DEFAULT_POLICY = "ACCEPT"
+    IPTABLES_RULES = ["-A INPUT -i eth0 -j DROP"]
+
+    def test_reuse_constraints(self, st: SolveTables):
+        chain_constraints = st._get_chain_constraints("INPUT")
+        base_constraints = st._get_base_constraints()
+        st.build_constraints("INPUT")
+        assert st._get_chain_constraints("INPUT") is chain_constraints
+        assert st._get_base_constraints() is base_constraints
+
+    def test_new_interface_invalidates(self, st: SolveTables):
+        constraints = st.build_constraints("INPUT")
+        additional_constraints = SolveTablesExpression(
+            "in_iface == eth1", st
+        ).get_constraints()
+        assert not st.build_constraints("INPUT").eq(constraints)
+
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is not None
+        model_dict = st.translate_model(model)
+        assert model_dict["input_interface"] == "eth1"
+
+    def test_repeated_queries(self, st: SolveTables):
+        drop_constraints = SolveTablesExpression(
+            "in_iface == eth0", st
+        ).get_constraints()
+        accept_constraints = SolveTablesExpression(
+            "in_iface == eth1", st
+        ).get_constraints()
+        for _ in range(2):
+            assert (
+                st.check_and_get_model(chain="INPUT", constraints=drop_constraints)
+                is None
+            )
+            model = st.check_and_get_model(
+                chain="INPUT", constraints=accept_constraints
+            )
+            assert model is not None
+            assert st.translate_model(model)["input_interface"] == "eth1"
+
+
+class TestOverlappingRulesDefaultDrop(BaseTest):
+    DEFAULT_POLICY = "DROP"
+    IPTABLES_RULES = [
+        "-A INPUT -s 10.0.0.1 -p udp -j ACCEPT",
+        "-A INPUT -s 10.0.0.0/8 -j ACCEPT",
+        "-A INPUT -s 10.0.0.1 -j ACCEPT",
+    ]
+
+    def test_hit_first_matching(self, st: SolveTables):
+        additional_constraints = SolveTablesExpression(
+            "src_ip == 10.0.0.1 and protocol == tcp", st
+        ).get_constraints()
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is not None
+
+        rules = st.identify_rule_from_model(chain="INPUT", model=model)
+        assert rules is not None
+        assert len(rules) == 1
+        assert rules[0].iptables_rule == self.IPTABLES_RULES[1]
+
+
+class TestMultiportDefaultDrop(BaseTest):
+    DEFAULT_POLICY = "DROP"
+    IPTABLES_RULES = [
+        "-A INPUT -p tcp -m multiport --dports 443,80,8000:8080,8081 -j ACCEPT",
+    ]
+
+    def test_accept_listed_port(self, st: SolveTables):
+        additional_constraints = SolveTablesExpression(
+            "dst_port == 443", st
+        ).get_constraints()
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is not None
+        model_dict = st.translate_model(model)
+        assert model_dict["dst_port"] == 443
+        assert model_dict["protocol"] == "tcp"
+
+        rules = st.identify_rule_from_model(chain="INPUT", model=model)
+        assert rules is not None
+        assert len(rules) == 1
+        assert rules[0].iptables_rule == self.IPTABLES_RULES[0]
+
+    def test_accept_range_port(self, st: SolveTables):
+        additional_constraints = SolveTablesExpression(
+            "dst_port == 8081", st
+        ).get_constraints()
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is not None
+        model_dict = st.translate_model(model)
+        assert model_dict["dst_port"] == 8081
+
+    def test_drop_unlisted_port(self, st: SolveTables):
+        additional_constraints = SolveTablesExpression(
+            "dst_port == 81", st
+        ).get_constraints()
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is None
+
+
+class TestNotMultiportDefaultAccept(BaseTest):
+    DEFAULT_POLICY = "ACCEPT"
+    IPTABLES_RULES = [
+        "-A INPUT -p tcp -m multiport ! --dports 22,23,1024: -j DROP",
+    ]
+
+    def test_accept_listed_port(self, st: SolveTables):
+        additional_constraints = SolveTablesExpression(
+            "dst_port == 23 and protocol == tcp", st
+        ).get_constraints()
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is not None
+        model_dict = st.translate_model(model)
+        assert model_dict["dst_port"] == 23
+
+    def test_accept_open_range_port(self, st: SolveTables):
+        additional_constraints = SolveTablesExpression(
+            "dst_port == 65535 and protocol == tcp", st
+        ).get_constraints()
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is not None
+
+    def test_drop_unlisted_port(self, st: SolveTables):
+        additional_constraints = SolveTablesExpression(
+            "dst_port == 80 and protocol == tcp", st
+        ).get_constraints()
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is None
+
+
+class TestSharedRuleConstraintsDefaultDrop(BaseTest):
+    DEFAULT_POLICY = "DROP"
+    IPTABLES_RULES = [
+        "-A INPUT -s 10.0.0.1 -j CUSTOM",
+        "-A CUSTOM -s 10.0.0.1 -j ACCEPT",
+    ]
+
+    def test_hit_both(self, st: SolveTables):
+        additional_constraints = SolveTablesExpression(
+            "src_ip == 10.0.0.1", st
+        ).get_constraints()
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is not None
+
+        rules = st.identify_rule_from_model(chain="INPUT", model=model)
+        assert rules is not None
+        assert len(rules) == 2
+        assert rules[0].iptables_rule == self.IPTABLES_RULES[0]
+        assert rules[1].iptables_rule == self.IPTABLES_RULES[1]
+
+    def test_drop_other(self, st: SolveTables):
+        additional_constraints = SolveTablesExpression(
+            "src_ip == 10.0.0.2", st
+        ).get_constraints()
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is None
+
+
+class TestUnreachableUnsupportedRuleDefaultDrop(BaseTest):
+    DEFAULT_POLICY = "DROP"
+    IPTABLES_RULES = [
+        "-A FORWARD -m state --state INVALID -j DROP",
+        "-A INPUT -p tcp --dport 22 -j ACCEPT",
+    ]
+
+    def test_hit_input(self, st: SolveTables):
+        additional_constraints = SolveTablesExpression(
+            "dst_port == 22", st
+        ).get_constraints()
+        model = st.check_and_get_model(
+            chain="INPUT", constraints=additional_constraints
+        )
+        assert model is not None
+
+        rules = st.identify_rule_from_model(chain="INPUT", model=model)
+        assert rules is not None
+        assert len(rules) == 1
+        assert rules[0].iptables_rule == self.IPTABLES_RULES[1]